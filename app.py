@@ -1,11 +1,43 @@
+# gevent 必須在其他模組（尤其 requests/httpx 的 socket/ssl）載入前 monkey patch，
+# 讓阻塞 I/O 變成協作式切換；未安裝 gevent（本機直接執行）時照常運作
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:
+    pass
+
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import HttpClient, RequestsHttpClient, RequestsHttpResponse
 from linebot.models import *
 
 import os
+import re
+import hmac
 import time
-import traceback
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import base64
+import random
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# FAISS 為選用加速：沒安裝時自動退回 NumPy 矩陣內積
+try:
+    import faiss
+except ImportError:
+    faiss = None
+import numpy as np
 # 引入 Google GenAI SDK
 from google import genai
 from google.genai import types
@@ -14,134 +46,918 @@ from google.genai.errors import APIError
 # 初始化 Flask
 app = Flask(__name__)
 
+# 日誌 I/O 移到背景執行緒：請求/工作執行緒只把紀錄丟進佇列，
+# 由 QueueListener 負責實際寫出，stdout 不再是請求路徑上的同步點
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(
+    logging.Formatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+)
+_log_listener = QueueListener(_log_queue, _log_output, respect_handler_level=True)
+_log_listener.start()
+app.logger.handlers = [QueueHandler(_log_queue)]
+app.logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+class PooledLineHttpClient(RequestsHttpClient):
+    """以長駐的 requests.Session 連線池呼叫 LINE API。
+
+    預設的 RequestsHttpClient 每次都走模組層級的 requests.get/post，
+    無法重用連線；改用 Session + HTTPAdapter 省下每次 TLS 握手的成本。
+    """
+
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", HTTPAdapter(pool_connections=32, pool_maxsize=32)
+        )
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout)
+        return RequestsHttpResponse(response)
+
+
 # Channel Access Token / Secret
-line_bot_api = LineBotApi(os.getenv('CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.getenv('CHANNEL_SECRET'))
+CHANNEL_SECRET = os.getenv('CHANNEL_SECRET') or ''
+line_bot_api = LineBotApi(os.getenv('CHANNEL_ACCESS_TOKEN'), http_client=PooledLineHttpClient)
+handler = WebhookHandler(CHANNEL_SECRET)
 
 # 從環境變數獲取 Gemini API Key (請確保您的環境變數名稱為 GEMINI_API_KEY)
 gemini_api_key = os.getenv('GEMINI_API_KEY')
 if not gemini_api_key:
-    print("警告：未設定 GEMINI_API_KEY 環境變數！API 呼叫將會失敗。")
+    app.logger.warning("未設定 GEMINI_API_KEY 環境變數！API 呼叫將會失敗。")
 
 # 初始化 Gemini Client
 # 客戶端會自動從環境變數 GEMINI_API_KEY 讀取金鑰
 try:
-    client = genai.Client()
+    # 放大 httpx 連線池上限，讓多個背景執行緒能重用 keep-alive 連線
+    client = genai.Client(
+        http_options=types.HttpOptions(
+            client_args={
+                "limits": httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            },
+        )
+    )
 except Exception as e:
-    print(f"初始化 Gemini 客戶端失敗: {e}")
+    app.logger.error("初始化 Gemini 客戶端失敗: %s", e)
     client = None
 
-# Gemini 回覆函數
-def GEMINI_response(user_text):
+# ========= RAG 知識庫設定 =========
+DB_FILE = "knowledge_base.db"
+# 只有明確設定 RESET_DB=1 才重建知識庫；平常重啟沿用既有資料，
+# 避免每次部署都重新向量化全部預設資料
+RESET_DB = os.getenv("RESET_DB", "0") == "1"
+EMBEDDING_MODEL = "text-embedding-004"
+EMBEDDING_DIM = 768
+RAG_CONFIDENCE_THRESHOLD = 0.75  # 餘弦相似度高於此值才視為高信心命中
+
+# 預設知識庫內容（冷啟動時自動寫入）
+initial_knowledge_data = [
+    "本公司客服信箱為 support@mycompany.com，服務時間為週一至週五 09:00-18:00。",
+    "我們的產品在 2024 年使用者滿意度調查中獲得 6.91 分（滿分 10 分）。",
+    "退貨政策：商品到貨後 7 天內可申請退貨，退貨時需保持包裝完整。",
+    "付款方式支援信用卡、LINE Pay 與銀行轉帳。",
+    "標準出貨時間為付款完成後 2 個工作天內。",
+    "會員升級條件：單一年度累積消費滿 5000 元即可升級為 VIP 會員。",
+]
+
+# 記憶體中的向量矩陣與對應文字（啟動時載入一次，查詢不再碰 SQLite）
+KB_EMB = np.empty((0, EMBEDDING_DIM), dtype=np.float32)  # shape [N, 768]
+KB_TEXT = []
+KB_INDEX = None  # faiss HNSW 索引（faiss 可用時）
+KB_LOCK = threading.Lock()  # 保護 KB_EMB / KB_TEXT / KB_INDEX 的寫入
+
+
+# 整個程序共用一條 SQLite 連線（以 DB_LOCK 保護），
+# 避免每次查詢/寫入都重新付出建立連線與鎖定設定的成本。
+DB_CONN = None
+DB_LOCK = threading.Lock()
+
+
+def _open_db_connection():
+    """開啟全程序共用的 SQLite 連線，並設定效能相關 PRAGMA。"""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")   # 256MB：讀取走 mmap，少一次使用者空間拷貝
+    conn.execute("PRAGMA cache_size=-65536")     # 64MB page cache（負值單位為 KB）
+    return conn
+
+
+def setup_db():
+    """建立知識庫資料表（不存在時），並處理舊結構的遷移。"""
+    with DB_LOCK:
+        DB_CONN.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        """)
+        cols = {
+            r["name"]
+            for r in DB_CONN.execute("PRAGMA table_info(knowledge_base)")
+        }
+        if cols and "scale" not in cols:
+            # 舊版 float32 BLOB 結構：重建資料表並清掉種子雜湊，讓預設資料重新寫入
+            DB_CONN.execute("DROP TABLE knowledge_base")
+            DB_CONN.execute("DELETE FROM meta WHERE key = 'seed_hash'")
+        DB_CONN.execute("""
+            CREATE TABLE IF NOT EXISTS knowledge_base (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                scale REAL NOT NULL
+            )
+        """)
+        # FTS5 關鍵字索引：補足向量檢索對 email、分數等精確字串的召回
+        DB_CONN.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts
+            USING fts5(content, content='knowledge_base', content_rowid='id')
+        """)
+        DB_CONN.execute("""
+            CREATE TRIGGER IF NOT EXISTS knowledge_fts_ai
+            AFTER INSERT ON knowledge_base BEGIN
+                INSERT INTO knowledge_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        DB_CONN.execute("""
+            CREATE TRIGGER IF NOT EXISTS knowledge_fts_ad
+            AFTER DELETE ON knowledge_base BEGIN
+                INSERT INTO knowledge_fts(knowledge_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END
+        """)
+        DB_CONN.execute("""
+            CREATE TRIGGER IF NOT EXISTS knowledge_fts_au
+            AFTER UPDATE ON knowledge_base BEGIN
+                INSERT INTO knowledge_fts(knowledge_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+                INSERT INTO knowledge_fts(rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        # 既有資料在建立 FTS 索引前寫入時不會經過 trigger：啟動時重建一次
+        DB_CONN.execute("INSERT INTO knowledge_fts(knowledge_fts) VALUES ('rebuild')")
+
+
+def _norm(v):
+    """轉成 float32 並做 L2 正規化（單位向量之間的內積即餘弦相似度）。"""
+    v = np.asarray(v, dtype=np.float32)
+    return v / (np.linalg.norm(v) + 1e-12)
+
+
+def _quantize_embedding(v):
+    """把向量對稱量化成 int8，回傳 (bytes, scale)；儲存空間縮為 float32 的 1/4。"""
+    v = np.asarray(v, dtype=np.float32)
+    scale = float(np.abs(v).max()) or 1.0
+    q = np.round(v / scale * 127.0).astype(np.int8)
+    return q.tobytes(), scale
+
+
+def _embed_one(text):
+    """單一字串的實際 Embedding API 呼叫（不經快取）；回傳 tuple。"""
+    result = client.models.embed_content(
+        model=EMBEDDING_MODEL,
+        contents=text,
+    )
+    return tuple(result.embeddings[0].values)
+
+
+# 查詢端的快取層：text-embedding-004 的輸出是確定性的，程序重啟時快取失效即可。
+# 回傳 tuple 以便快取（可雜湊、不可變）。
+_embed_cached = lru_cache(maxsize=1024)(_embed_one)
+
+
+def get_embedding(text, use_cache=True):
+    """呼叫 Gemini Embedding API，回傳正規化後的 768 維向量（失敗時回傳 None）。
+
+    text 可為單一字串或字串清單：清單會在一次 API 往返內整批向量化，
+    回傳向量清單。單一字串（去除前後空白、小寫化後）預設走記憶體快取；
+    寫入知識庫這類一次性的向量化應傳 use_cache=False，避免佔據查詢快取。
+    """
+    if not client:
+        return None
+    try:
+        if isinstance(text, (list, tuple)):
+            result = client.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=list(text),
+            )
+            return [_norm(emb.values) for emb in result.embeddings]
+        embed = _embed_cached if use_cache else _embed_one
+        return _norm(embed(text.strip().lower()))
+    except Exception as e:
+        app.logger.error("[Embedding Error] %s", e)
+        return None
+
+
+def _seed_hash():
+    """計算預設資料內容清單的雜湊，用來判斷是否需要增量更新。"""
+    h = hashlib.sha256()
+    for content in initial_knowledge_data:
+        h.update(content.encode("utf-8"))
+    return h.hexdigest()
+
+
+def initialize_knowledge_base():
+    """增量初始化：預設資料沒變時直接返回，變動時只向量化新增的內容。"""
+    seed_hash = _seed_hash()
+    with DB_LOCK:
+        row = DB_CONN.execute(
+            "SELECT value FROM meta WHERE key = 'seed_hash'"
+        ).fetchone()
+    if row and row["value"] == seed_hash:
+        return
+
+    if not client:
+        app.logger.warning("[RAG] Gemini 客戶端未初始化，知識庫暫不寫入預設資料。")
+        return
+
+    with DB_LOCK:
+        existing = {
+            r["content"]
+            for r in DB_CONN.execute("SELECT content FROM knowledge_base")
+        }
+    missing = [c for c in initial_knowledge_data if c not in existing]
+
+    rows = []
+    if missing:
+        app.logger.info("[RAG] 偵測到 %d 筆新的預設資料，開始向量化...", len(missing))
+        # get_embedding 接受字串清單：一次 API 往返取回全部向量
+        vectors = get_embedding(missing)
+        if vectors is None:
+            app.logger.error("[RAG] 批次向量化失敗，知識庫未初始化。")
+            return
+        for content, vec in zip(missing, vectors):
+            blob, scale = _quantize_embedding(vec)
+            rows.append((content, blob, scale))
+
+    # 整批資料與種子雜湊放在同一個交易：executemany 一次交給 C 層，
+    # 也避免中途失敗留下「資料寫了一半但雜湊未更新」以外的狀態
+    with DB_LOCK:
+        DB_CONN.execute("BEGIN IMMEDIATE")
+        try:
+            if rows:
+                DB_CONN.executemany(
+                    "INSERT INTO knowledge_base (content, embedding, scale) VALUES (?, ?, ?)",
+                    rows,
+                )
+            DB_CONN.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('seed_hash', ?)",
+                (seed_hash,),
+            )
+            DB_CONN.execute("COMMIT")
+        except Exception:
+            DB_CONN.execute("ROLLBACK")
+            raise
+    app.logger.info("[RAG] 知識庫初始化完成。")
+
+
+def _load_kb_into_memory():
+    """啟動時一次性把知識庫載入記憶體，堆成 NumPy float32 矩陣。
+
+    之後的查詢路徑只碰 NumPy（與 FAISS 索引）；SQLite 僅在寫入時使用。
+    """
+    global KB_EMB, KB_TEXT
+    with DB_LOCK:
+        rows = DB_CONN.execute(
+            "SELECT id, content, embedding, scale FROM knowledge_base ORDER BY id"
+        ).fetchall()
+
+    texts = [row["content"] for row in rows]
+    if rows:
+        # 整批向量化還原：所有 int8 blob 串成一段連續 bytes，
+        # 一次 frombuffer + reshape，再用 scale 向量廣播還原 float32 並重新正規化，
+        # 不在 Python 迴圈裡逐列解碼
+        blob = b"".join(row["embedding"] for row in rows)
+        scales = np.asarray([row["scale"] for row in rows], dtype=np.float32)
+        M = np.frombuffer(blob, dtype=np.int8).astype(np.float32)
+        M = M.reshape(len(rows), EMBEDDING_DIM)
+        M *= (scales / 127.0)[:, None]
+        M /= np.linalg.norm(M, axis=1, keepdims=True) + 1e-12
+    else:
+        M = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    with KB_LOCK:
+        KB_TEXT = texts
+        KB_EMB = M
+        _build_kb_index()
+    app.logger.info("[RAG] 已載入 %d 筆知識到記憶體向量矩陣。", len(texts))
+
+
+def _build_kb_index():
+    """以 FAISS HNSW 建立 ANN 索引（向量已正規化，內積即餘弦相似度）。
+
+    知識庫成長到數千筆以上時提供次線性查詢；faiss 未安裝時維持 None，
+    查詢端退回整個矩陣的內積。呼叫端須持有 KB_LOCK。
+    """
+    global KB_INDEX
+    if faiss is None or not KB_EMB.size:
+        KB_INDEX = None
+        return
+    index = faiss.IndexHNSWFlat(EMBEDDING_DIM, 32, faiss.METRIC_INNER_PRODUCT)
+    index.add(KB_EMB)
+    KB_INDEX = index
+
+
+def _vector_search(query_embedding, limit):
+    """向量檢索：回傳依相似度遞減排序的 (內容, 相似度) 清單。
+
+    只在鎖內取得快照參考（O(1)），計分在鎖外進行；寫入端一律以
+    「建新物件後整組替換」的方式更新，快照在計分期間保持自洽。
+    """
+    with KB_LOCK:
+        emb, texts, index = KB_EMB, KB_TEXT, KB_INDEX
+    if not emb.size:
+        return []
+    q = _norm(query_embedding)
+    k = min(limit, len(texts))
+
+    if index is not None:
+        scores, idx = index.search(q[None, :], k)
+        return [
+            (texts[i], float(s))
+            for s, i in zip(scores[0], idx[0])
+            if i != -1
+        ]
+
+    scores = emb @ q
+    idx = np.argpartition(-scores, k - 1)[:k]
+    idx = idx[np.argsort(-scores[idx])]
+    return [(texts[i], float(scores[i])) for i in idx]
+
+
+def _fts_search(query_text, limit=20):
+    """FTS5 關鍵字檢索，回傳依 rank 排序的內容清單。
+
+    註：FTS5 預設 tokenizer 不會對中文斷詞，主要補足 email、數字、
+    英文關鍵字這類精確字串的召回。
+    """
+    terms = re.findall(r"[\w.@-]+", query_text)
+    if not terms:
+        return []
+    match = " OR ".join(f'"{t}"' for t in terms)
+    try:
+        with DB_LOCK:
+            rows = DB_CONN.execute(
+                "SELECT content FROM knowledge_fts WHERE knowledge_fts MATCH ? "
+                "ORDER BY rank LIMIT ?",
+                (match, limit),
+            ).fetchall()
+    except sqlite3.OperationalError as e:
+        app.logger.warning("[FTS Error] %s", e)
+        return []
+    return [r["content"] for r in rows]
+
+
+def query_knowledge_base(query_embedding, query_text=None, top_k=3):
+    """向量 + 關鍵字混合檢索，回傳 (top_k 筆 (內容, 相似度), 向量最高相似度)。
+
+    兩路名次以 Reciprocal Rank Fusion（score = Σ 1/(60+rank)）融合，
+    讓向量相似度漏掉的精確關鍵字命中也能進入參考資料。
+    信心判斷必須用融合前的向量最高相似度：融合名次可能把最佳向量命中
+    擠出 top_k，不能拿融合後子集的分數當信心依據。
+    """
+    vec_results = _vector_search(query_embedding, limit=max(top_k, 10))
+    best_sim = vec_results[0][1] if vec_results else 0.0
+
+    fts_results = _fts_search(query_text) if query_text else []
+    if not fts_results:
+        return vec_results[:top_k], best_sim
+
+    fused = {}
+    for rank, (content, _score) in enumerate(vec_results):
+        fused[content] = fused.get(content, 0.0) + 1.0 / (60 + rank)
+    for rank, content in enumerate(fts_results):
+        fused[content] = fused.get(content, 0.0) + 1.0 / (60 + rank)
+
+    sims = dict(vec_results)
+    top = sorted(fused, key=fused.get, reverse=True)[:top_k]
+    return [(content, sims.get(content, 0.0)) for content in top], best_sim
+
+
+def add_new_knowledge(content):
+    """新增一筆知識：寫入 SQLite 並同步附加到記憶體矩陣。
+
+    記憶體端以替換（而非就地修改）更新：vstack 產生新矩陣、串接產生
+    新清單、索引整個重建，讀取端先前拿到的快照不會被改動。
+    """
+    global KB_EMB, KB_TEXT
+    embedding = get_embedding(content, use_cache=False)
+    if embedding is None:
+        return False
+
+    blob, scale = _quantize_embedding(embedding)
+    with DB_LOCK:
+        DB_CONN.execute(
+            "INSERT INTO knowledge_base (content, embedding, scale) VALUES (?, ?, ?)",
+            (content, blob, scale),
+        )
+
+    vec = np.asarray(embedding, dtype=np.float32)
+    with KB_LOCK:
+        KB_EMB = np.vstack([KB_EMB, vec[None, :]])
+        KB_TEXT = KB_TEXT + [content]
+        _build_kb_index()
+    return True
+
+
+# ========= RAG 答案快取（精確鍵） =========
+# 以 (正規化問題, 參考資料雜湊) 為鍵：同樣的問題在知識庫內容改變後
+# 雜湊跟著變，不會回覆過期答案。僅快取受限 RAG 生成——
+# 走 Google Search 的回答可能依賴即時資訊，不在此快取。
+RAG_ANSWER_CACHE = OrderedDict()
+RAG_ANSWER_CACHE_MAX = 512
+RAG_ANSWER_LOCK = threading.Lock()
+
+
+def _rag_answer_get(key):
+    with RAG_ANSWER_LOCK:
+        answer = RAG_ANSWER_CACHE.get(key)
+        if answer is not None:
+            RAG_ANSWER_CACHE.move_to_end(key)
+        return answer
+
+
+def _rag_answer_put(key, answer):
+    with RAG_ANSWER_LOCK:
+        RAG_ANSWER_CACHE[key] = answer
+        RAG_ANSWER_CACHE.move_to_end(key)
+        if len(RAG_ANSWER_CACHE) > RAG_ANSWER_CACHE_MAX:
+            RAG_ANSWER_CACHE.popitem(last=False)
+
+
+# ========= 語意回覆快取 =========
+# 近似重複的提問（相似度 > 0.95）直接回覆先前生成的答案，
+# 同時省掉 generate_content 與知識庫檢索。
+# 只存放非 RAG 的回答：受限 RAG 答案依賴知識庫內容，
+# 由 RAG_ANSWER_CACHE 以參考資料雜湊控制失效。
+ANS_CACHE_MAX = 512
+ANS_SIM_THRESHOLD = 0.95
+ANS_EMB = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+ANS_TEXT = []
+ANS_LOCK = threading.Lock()
+
+
+def _semantic_cache_get(query_embedding):
+    """查詢語意快取；相似度超過門檻時回傳快取答案，否則回傳 None。"""
+    global ANS_EMB
+    with ANS_LOCK:
+        if not ANS_EMB.size:
+            return None
+        sims = ANS_EMB @ query_embedding
+        j = int(sims.argmax())
+        if sims[j] <= ANS_SIM_THRESHOLD:
+            return None
+        # LRU：命中項移到最後，之後淘汰時從最前面開始丟
+        answer = ANS_TEXT.pop(j)
+        ANS_TEXT.append(answer)
+        row = ANS_EMB[j]
+        ANS_EMB = np.vstack([np.delete(ANS_EMB, j, axis=0), row[None, :]])
+        return answer
+
+
+def _semantic_cache_put(query_embedding, answer):
+    """把 (查詢向量, 答案) 放入語意快取，超過容量時淘汰最舊的一筆。"""
+    global ANS_EMB
+    with ANS_LOCK:
+        ANS_TEXT.append(answer)
+        ANS_EMB = np.vstack([ANS_EMB, np.asarray(query_embedding, dtype=np.float32)[None, :]])
+        if len(ANS_TEXT) > ANS_CACHE_MAX:
+            ANS_TEXT.pop(0)
+            ANS_EMB = ANS_EMB[1:]
+
+
+# 知識庫初始化：延遲到第一個請求（或 __main__ 啟動）才執行，且整個程序只跑一次。
+# 匯入模組本身不再觸發刪檔、建表與向量化 API 呼叫。
+_INIT_LOCK = threading.Lock()
+_initialized = False
+
+
+def _ensure_initialized():
+    """準備資料庫連線、種子資料與記憶體索引；重入時直接返回。"""
+    global _initialized, DB_CONN
+    if _initialized:
+        return
+    with _INIT_LOCK:
+        if _initialized:
+            return
+        if RESET_DB and os.path.exists(DB_FILE):
+            os.remove(DB_FILE)
+        DB_CONN = _open_db_connection()
+        setup_db()
+        initialize_knowledge_base()
+        _load_kb_into_memory()
+        _initialized = True
+
+
+# webhook 工作執行緒池：/callback 收到事件後立即回 200，生成在背景進行
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+# 生成過程中並行發出的 API 子任務（向量化、推測性生成）用獨立的池，
+# 避免與 webhook 工作互搶執行緒造成巢狀提交的飢餓
+API_EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# 句子邊界（中英文標點），作為分段推播的切點
+SENTENCE_BOUNDARY = re.compile(r'[.?!。！？]')
+# 第一段在第一個句子邊界就送出（縮短首段等待時間）；
+# 之後累積到此長度再送，避免對使用者推播過多則訊息
+STREAM_CHUNK_MIN = 200
+# LINE 限制訊息長度（最多約 2000 字元）
+MAX_ANSWER_LEN = 2000
+
+
+# 生成參數只有兩種組合，啟動時各建一次，不在每則訊息重新建構與驗證。
+# 共享實例不可在呼叫時改欄位（多執行緒），動態的 RAG 參考資料改放進提示詞。
+# 【修正】tools 參數須放在 config 內，符合 google-genai SDK 要求
+CFG_RAG_STRICT = types.GenerateContentConfig(
+    temperature=0.5,
+    max_output_tokens=500, # 限制最大輸出 Token 數量
+    # 高信心命中：只根據知識庫內容回答，不使用搜尋工具
+    system_instruction=(
+        "請優先根據訊息開頭【參考資料】區塊的內容回答使用者的問題，"
+        "若參考資料不足以回答，請誠實告知。"
+    ),
+)
+CFG_NO_RAG = types.GenerateContentConfig(
+    temperature=0.5,
+    max_output_tokens=500, # 限制最大輸出 Token 數量
+    tools=[{"google_search": {}}],
+)
+
+
+def _build_prompt(user_text, rag_context):
+    """組合提示詞：RAG 命中時把參考資料放在開頭（穩定前綴利於隱式快取），使用者問題放最後。"""
+    if rag_context:
+        return f"【參考資料】\n{rag_context}\n\n【使用者問題】\n{user_text}"
+    return user_text
+
+
+# Gemini 顯式快取有最低 token 門檻，參考資料太短時建快取反而多一次往返；
+# 以字元數粗估（中文約 1 字 1 token 以上，4096 字元穩超過門檻）
+EXPLICIT_CACHE_MIN_CHARS = 4096
+EXPLICIT_CACHE_TTL_SECS = 300
+_RAG_CACHE_NAMES = {}  # 參考資料雜湊 → (cached_content 名稱, 過期時間)
+_RAG_CACHE_LOCK = threading.Lock()
+
+
+def _cached_content_for(rag_context):
+    """參考資料夠長時建立（或重用）Gemini 顯式快取，回傳 cached_content 名稱。
+
+    快取 token 計價有大幅折扣，且相同參考資料連續多輪提問時不必重傳。
+    太短、建立失敗或已過期時回傳 None，走一般路徑。
+    """
+    if len(rag_context) < EXPLICIT_CACHE_MIN_CHARS:
+        return None
+    key = hashlib.blake2b(rag_context.encode("utf-8"), digest_size=8).hexdigest()
+    now = time.time()
+    with _RAG_CACHE_LOCK:
+        entry = _RAG_CACHE_NAMES.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+    try:
+        cached = client.caches.create(
+            model="gemini-2.5-flash",
+            config=types.CreateCachedContentConfig(
+                system_instruction=CFG_RAG_STRICT.system_instruction,
+                contents=[f"【參考資料】\n{rag_context}"],
+                ttl=f"{EXPLICIT_CACHE_TTL_SECS}s",
+            ),
+        )
+    except Exception as e:
+        app.logger.warning("[Cache Error] 建立顯式快取失敗: %s", e)
+        return None
+    with _RAG_CACHE_LOCK:
+        # 提前 30 秒視為過期，避免拿到邊界上剛失效的快取
+        _RAG_CACHE_NAMES[key] = (cached.name, now + EXPLICIT_CACHE_TTL_SECS - 30)
+    return cached.name
+
+
+def _split_for_push(text):
+    """把完整答案照推播策略切段：第一段到第一個句子邊界，其餘每段至少 STREAM_CHUNK_MIN。"""
+    chunks = []
+    rest = text.strip()
+    min_len = 1
+    while rest:
+        match = SENTENCE_BOUNDARY.search(rest, min_len - 1)
+        if not match or match.end() >= len(rest):
+            chunks.append(rest)
+            break
+        piece, rest = rest[:match.end()], rest[match.end():].strip()
+        chunks.append(piece.strip())
+        min_len = STREAM_CHUNK_MIN
+    return [c for c in chunks if c]
+
+
+def _vanilla_generate(user_text):
+    """推測性的一般生成（無 RAG 情境），與查詢向量化並行發出。"""
+    return client.models.generate_content(
+        model="gemini-2.5-flash",
+        contents=user_text,
+        config=CFG_NO_RAG,
+    )
+
+
+def _empty_response_detail(last_chunk):
+    """從串流最後一個 chunk 判讀沒有文字輸出的原因。"""
+    error_detail = "API 回應中無文字內容。"
+    if last_chunk is not None and last_chunk.candidates:
+        finish_reason = last_chunk.candidates[0].finish_reason
+        if finish_reason is not None:
+            finish_reason = finish_reason.name
+            if finish_reason == "SAFETY":
+                # 內容被安全過濾器阻擋
+                error_detail = "內容被安全過濾器阻擋，請嘗試調整提問。"
+            elif finish_reason == "RECITATION":
+                # 模型拒絕回應（例如：潛在違反使用政策，或需要外部知識但未成功獲取）
+                error_detail = "模型拒絕回應，請嘗試提供更多情境或調整提問。"
+            else:
+                error_detail = f"模型完成原因: {finish_reason}，但沒有生成文字。"
+    return error_detail
+
+
+# Gemini 回覆函數（generator，逐段回傳文字）
+def GEMINI_response_stream(user_text):
     """
-    呼叫 Google Gemini API (gemini-2.5-flash) 生成回覆，內含重試機制與錯誤處理。
-    同時啟用 Google Search 工具以處理需要即時資訊的問題。
+    呼叫 Google Gemini API (gemini-2.5-flash) 以串流方式生成回覆，
+    在句子邊界切段逐段 yield，內含重試機制與錯誤處理。
+    會先以向量檢索查詢知識庫，高信心命中時以知識庫內容作答；
+    否則啟用 Google Search 工具以處理需要即時資訊的問題。
     """
     if not client:
-        return "⚠️ Gemini 客戶端未成功初始化，請檢查您的 GEMINI_API_KEY。"
+        yield "⚠️ Gemini 客戶端未成功初始化，請檢查您的 GEMINI_API_KEY。"
+        return
 
-    max_retries = 3
-    delay = 2
+    # ===== RAG 檢索（與推測性生成並行） =====
+    # 向量化與一般生成都是網路往返：同時發出，讓兩段延遲重疊。
+    # RAG 高信心命中時改跑受限生成、忽略推測結果；未命中時直接取用。
+    emb_future = API_EXECUTOR.submit(get_embedding, user_text)
+    spec_future = API_EXECUTOR.submit(_vanilla_generate, user_text)
 
-    for attempt in range(max_retries):
+    rag_context = ""
+    query_embedding = emb_future.result()
+    if query_embedding is not None:
+        # 語意快取：近似重複的提問直接回覆，不再呼叫生成 API
+        cached_answer = _semantic_cache_get(query_embedding)
+        if cached_answer is not None:
+            app.logger.debug("[Cache] 語意快取命中，直接回覆。")
+            yield cached_answer
+            return
+
+        results, best = query_knowledge_base(query_embedding, query_text=user_text, top_k=3)
+        if results and best >= RAG_CONFIDENCE_THRESHOLD:
+            rag_context = "\n".join(content for content, _ in results)
+            app.logger.debug("[RAG] 命中知識庫（向量最高相似度 %.3f）", best)
+
+    if not rag_context:
+        # 沒有高信心命中：直接使用已在途中的推測性生成結果
         try:
-            # 設置生成參數
-            # 【修正】將 tools 參數移入 config 內，符合 google-genai SDK 要求
+            response = spec_future.result()
+            if not response.text:
+                error_detail = _empty_response_detail(response)
+                app.logger.warning("[Gemini Error] Generation blocked or empty. Detail: %s", error_detail)
+                yield f"⚠️ 內容生成失敗：{error_detail}"
+                return
+
+            answer = response.text.strip()
+            if len(answer) > MAX_ANSWER_LEN:
+                answer = answer[:MAX_ANSWER_LEN] + "…（回覆過長，已截斷）"
+            for piece in _split_for_push(answer):
+                yield piece
+            if query_embedding is not None:
+                _semantic_cache_put(query_embedding, answer)
+            return
+        except APIError as e:
+            # 推測性生成失敗時退回下方含重試的串流路徑
+            app.logger.warning("[Gemini API Error] %s", e)
+        except Exception:
+            app.logger.exception("推測性生成失敗")
+
+    config = CFG_RAG_STRICT if rag_context else CFG_NO_RAG
+    prompt = _build_prompt(user_text, rag_context)
+    rag_cache_key = None
+    if rag_context:
+        rag_key = hashlib.blake2b(rag_context.encode("utf-8"), digest_size=8).hexdigest()
+        rag_cache_key = (user_text.strip().lower(), rag_key)
+        cached = _rag_answer_get(rag_cache_key)
+        if cached is not None:
+            app.logger.debug("[Cache] RAG 答案快取命中，直接回覆。")
+            for piece in _split_for_push(cached):
+                yield piece
+            return
+
+        cached_name = _cached_content_for(rag_context)
+        if cached_name:
+            # 參考資料已在伺服器端快取：只需送出使用者問題
             config = types.GenerateContentConfig(
                 temperature=0.5,
-                max_output_tokens=500, # 限制最大輸出 Token 數量
-                # 修正：將 Google Search 工具放入 config 內
-                tools=[{"google_search": {}}],
+                max_output_tokens=500,
+                cached_content=cached_name,
             )
+            prompt = user_text
+
+    max_retries = 3
 
-            # 呼叫 Gemini API (使用最新的 gemini-2.5-flash 模型)
-            response = client.models.generate_content(
+    for attempt in range(max_retries):
+        buffer = ""
+        parts = []          # 已送出的段落（用於語意快取）
+        total_len = 0
+        last_chunk = None
+        truncated = False
+
+        try:
+            # 呼叫 Gemini API 串流介面 (使用最新的 gemini-2.5-flash 模型)
+            stream = client.models.generate_content_stream(
                 model="gemini-2.5-flash",
-                contents=user_text,
+                contents=prompt,
                 config=config,
-                # 修正：這裡不再需要 tools 參數
             )
 
-            # 【關鍵修復】檢查是否有內容生成。如果 response.text 是 None，通常表示內容被阻擋或沒有輸出。
-            if not response.text:
-                error_detail = "API 回應中無文字內容。"
-                
-                # 嘗試從 candidates 獲取更多資訊 (檢查被阻擋的原因)
-                if response.candidates:
-                    candidate = response.candidates[0]
-                    finish_reason = candidate.finish_reason.name
-                    
-                    if finish_reason == "SAFETY":
-                        # 內容被安全過濾器阻擋
-                        error_detail = "內容被安全過濾器阻擋，請嘗試調整提問。"
-                    elif finish_reason == "RECITATION":
-                        # 模型拒絕回應（例如：潛在違反使用政策，或需要外部知識但未成功獲取）
-                        error_detail = "模型拒絕回應，請嘗試提供更多情境或調整提問。"
-                    else:
-                        error_detail = f"模型完成原因: {finish_reason}，但沒有生成文字。"
-
-                print(f"[Gemini Error] Generation blocked or empty. Detail: {error_detail}")
-                # 返回更具體的錯誤訊息
-                return f"⚠️ 內容生成失敗：{error_detail}"
-
-
-            # 取出回答文字 (現在確定 response.text 不為 None)
-            answer = response.text.strip()
+            for chunk in stream:
+                last_chunk = chunk
+                if not chunk.text:
+                    continue
+                buffer += chunk.text
 
-            # LINE 限制訊息長度（最多約 2000 字元）
-            if len(answer) > 2000:
-                answer = answer[:2000] + "…（回覆過長，已截斷）"
+                # 第一段到第一個句子邊界就先送出；之後累積到 STREAM_CHUNK_MIN 再送
+                min_len = 1 if not parts else STREAM_CHUNK_MIN
+                while len(buffer) >= min_len:
+                    match = SENTENCE_BOUNDARY.search(buffer, min_len - 1)
+                    if not match:
+                        break
+                    piece, buffer = buffer[:match.end()], buffer[match.end():]
+                    piece = piece.strip()
+                    if not piece:
+                        continue
+                    if total_len + len(piece) > MAX_ANSWER_LEN:
+                        # 超出上限的句子截到剩餘額度再送出，不能整句丟棄：
+                        # 否則第一句就超長時使用者只會收到截斷提示
+                        piece = piece[:MAX_ANSWER_LEN - total_len]
+                        truncated = True
+                        if piece:
+                            parts.append(piece)
+                            total_len += len(piece)
+                            yield piece
+                        break
+                    parts.append(piece)
+                    total_len += len(piece)
+                    yield piece
+                    min_len = STREAM_CHUNK_MIN
+                if truncated:
+                    break
 
-            return answer
+            remainder = buffer.strip()
+            if remainder and not truncated:
+                if total_len + len(remainder) > MAX_ANSWER_LEN:
+                    remainder = remainder[:MAX_ANSWER_LEN - total_len]
+                    truncated = True
+                if remainder:
+                    parts.append(remainder)
+                    yield remainder
+            if truncated:
+                yield "…（回覆過長，已截斷）"
+
+            # 【關鍵修復】沒有任何文字輸出時，回報被阻擋或無輸出的原因
+            # （已因超長截斷的情況不算生成失敗）
+            if not parts and not truncated:
+                error_detail = _empty_response_detail(last_chunk)
+                app.logger.warning("[Gemini Error] Generation blocked or empty. Detail: %s", error_detail)
+                yield f"⚠️ 內容生成失敗：{error_detail}"
+                return
+
+            # 成功生成的答案（完整串接後）放入快取。
+            # RAG 答案只進 RAG_ANSWER_CACHE：語意快取沒有參考資料雜湊，
+            # 存進去會在知識庫更新後繼續回覆舊答案
+            full_answer = "\n".join(parts)
+            if rag_cache_key is not None:
+                _rag_answer_put(rag_cache_key, full_answer)
+            elif query_embedding is not None:
+                _semantic_cache_put(query_embedding, full_answer)
+
+            return
 
         except APIError as e:
             # 處理 Gemini API 相關錯誤，例如認證失敗、配額用盡等
-            print(f"[Gemini API Error] {e}")
-            if attempt < max_retries - 1:
-                print(f"等待 {delay} 秒後重試...")
+            # （已送出部分內容時不重試，避免重複推播同樣的段落）
+            app.logger.warning("[Gemini API Error] %s", e)
+            if getattr(e, "code", 500) and getattr(e, "code", 500) < 500:
+                # 4xx（金鑰無效、請求格式錯誤等）重試也不會成功，直接回報
+                yield "⚠️ Gemini API 拒絕了這次請求，請檢查設定或稍後再試。"
+                return
+            if attempt < max_retries - 1 and not parts:
+                # 帶抖動的指數退避，避免多個重試端同步造成突波
+                delay = min(20, 2 * (2 ** attempt) * random.uniform(0.5, 1.5))
+                app.logger.info("等待 %.1f 秒後重試...", delay)
                 time.sleep(delay)
-                delay *= 2  # 指數退避
                 continue
-            return "⚠️ 目前系統忙碌或 Gemini API 無法回應，請稍後再試。"
+            yield "⚠️ 目前系統忙碌或 Gemini API 無法回應，請稍後再試。"
+            return
 
-        except Exception as e:
+        except Exception:
             # 處理其他未知錯誤，例如網路超時或解析錯誤
-            print(traceback.format_exc())
-            return "⚠️ 發生未知錯誤，請稍後再試。"
+            app.logger.exception("生成過程發生未知錯誤")
+            yield "⚠️ 發生未知錯誤，請稍後再試。"
+            return
 
 # ========= LINE Webhook =========
 @app.route("/callback", methods=['POST'])
 def callback():
-    signature = request.headers.get('X-Line-Signature')
-    body = request.get_data(as_text=True)
-    app.logger.info(f"Request body: {body}")
+    _ensure_initialized()
+    signature = request.headers.get('X-Line-Signature', '')
+    # 以 bytes 取出 body：HMAC 直接吃 bytes，避免先解碼再重新編碼一次
+    body = request.get_data(cache=False)
+
+    # 先自行驗證 HMAC-SHA256 簽章：無效流量在進入 handler 解析事件前就擋下
+    expected = base64.b64encode(
+        hmac.new(CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    ).decode()
+    if not hmac.compare_digest(expected, signature):
+        abort(400)
+
+    body_text = body.decode('utf-8')
+    app.logger.debug("Request body: %s", body_text)
 
     try:
-        handler.handle(body, signature)
+        handler.handle(body_text, signature)
     except InvalidSignatureError:
         # 處理簽章驗證失敗
         abort(400)
     return "OK"
 
 # ========= 處理文字訊息 =========
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event):
+def _push_target_id(event):
+    """取得此事件應推播的對象 ID（群組 / 聊天室 / 個人）。"""
+    source = event.source
+    if source.type == 'group':
+        return source.group_id
+    if source.type == 'room':
+        return source.room_id
+    return source.user_id
+
+
+def _process_text_message(event):
+    """背景執行緒：串流生成回覆並逐段推播。"""
     user_msg = event.message.text
-    print(f"[User Message]: {user_msg}")
+    app.logger.debug("[User Message]: %s", user_msg)
+    target_id = _push_target_id(event)
 
-    # 改為呼叫 Gemini 回覆函數
-    reply_text = GEMINI_response(user_msg)
-    print(f"[Gemini Reply]: {reply_text}")
+    try:
+        for chunk in GEMINI_response_stream(user_msg):
+            app.logger.debug("[Gemini Reply]: %s", chunk)
+            line_bot_api.push_message(target_id, TextSendMessage(text=chunk))
+    except Exception:
+        app.logger.exception("背景處理文字訊息失敗")
 
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=reply_text)
-    )
+
+# 進行中的訊息工作：同一對話重複送出同樣文字（連點）時不重複生成
+INFLIGHT = {}
+INFLIGHT_LOCK = threading.Lock()
+
+
+def _pop_inflight(key):
+    with INFLIGHT_LOCK:
+        INFLIGHT.pop(key, None)
+
+
+@handler.add(MessageEvent, message=TextMessage)
+def handle_text_message(event):
+    # 把生成工作丟進執行緒池後立即返回，讓 webhook 馬上回 200，
+    # 避免 Flask worker 被 Gemini 的 1~3 秒延遲卡住（reply_token 也不會過期）
+    key = (_push_target_id(event), event.message.text.strip())
+    with INFLIGHT_LOCK:
+        if key in INFLIGHT:
+            # 同樣的訊息已在處理中，結果會推播到同一個對話：略過這次觸發
+            app.logger.debug("[Dedup] 相同訊息處理中，略過: %s", key[1][:30])
+            return
+        future = EXECUTOR.submit(_process_text_message, event)
+        INFLIGHT[key] = future
+    future.add_done_callback(lambda _f, key=key: _pop_inflight(key))
 
 # ========= 處理 Postback (維持原樣) =========
 @handler.add(PostbackEvent)
 def handle_postback(event):
-    print(f"[Postback Data]: {event.postback.data}")
+    app.logger.debug("[Postback Data]: %s", event.postback.data)
 
 # ========= 處理加入群組事件 (微調歡迎訊息) =========
 @handler.add(MemberJoinedEvent)
@@ -155,16 +971,17 @@ def welcome_new_member(event):
             name = profile.display_name
         else:
             name = "新朋友"
-            
+
         message = TextSendMessage(text=f"👋 歡迎 {name} 加入！我是由 Gemini 驅動的 AI 助手。")
         line_bot_api.reply_message(event.reply_token, message)
     except Exception as e:
-        print(f"發送歡迎訊息失敗: {e}")
+        app.logger.warning("發送歡迎訊息失敗: %s", e)
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"👋 歡迎新成員加入！"))
 
 
 # ========= 啟動 Flask =========
 if __name__ == "__main__":
+    _ensure_initialized()
     # 使用 Render 提供的 PORT 環境變數
     port = int(os.environ.get('PORT', 5000))
     app.run(host="0.0.0.0", port=port)